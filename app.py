@@ -5,9 +5,14 @@ import os
 import copy
 import time
 import uuid
-from openai import OpenAI
+import atexit
+from openai import OpenAI, BadRequestError
 from datetime import datetime
 from streamlit_local_storage import LocalStorage
+from scheduler import RequestScheduler, UserQuotaExceeded, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from prompt_layout import PROMPT_STRATEGIES, PrefixCacheStats, assemble_prompt, message_digest
+from streaming import checkpointed_stream
+from usage import UsageLedger, load_model_prices, usage_tokens
 
 # ================= 1. 基础配置与工具函数 =================
 st.set_page_config(page_title="暗夜刀锋 GM", page_icon="🗡️", layout="wide")
@@ -97,6 +102,81 @@ def get_api_client():
     return OpenAI(api_key=api_key, base_url=base_url)
 
 
+# ================= 1.1 请求调度器 (进程级) =================
+# 调度器本身在 scheduler.py，这里只负责按配置创建共享实例。
+# 公平排队和配额按用户 (浏览器) 计算，同一用户多开标签页或会话也只占一份。
+SCHED_REPLY_WEIGHT = float(get_config("SCHED_REPLY_WEIGHT", 1.0))
+SCHED_SUMMARY_WEIGHT = float(get_config("SCHED_SUMMARY_WEIGHT", 0.5))  # 总结请求更长，默认按 2 份计
+
+
+@st.cache_resource
+def get_scheduler():
+    """所有 Streamlit 会话共享同一个调度器实例"""
+    return RequestScheduler(
+        max_concurrency=get_config("SCHED_MAX_CONCURRENCY", 4),
+        rate_per_min=get_config("SCHED_RATE_PER_MIN", 0),
+        burst=get_config("SCHED_BURST"),
+        aging_seconds=get_config("SCHED_AGING_SECONDS", 5),
+        max_active_per_user=get_config("SCHED_MAX_ACTIVE_PER_USER", 2),
+        max_queued_per_user=get_config("SCHED_MAX_QUEUED_PER_USER", 4),
+    )
+
+
+def endpoint_key(client):
+    """按 Base URL 区分上游 Endpoint"""
+    return str(client.base_url)
+
+
+def get_user_id():
+    """浏览器级用户标识，随 Local Storage 一起持久化"""
+    user_id = st.session_state.get("storage_data", {}).get("user_id")
+    if user_id:
+        return user_id
+    if "user_id" not in st.session_state:
+        st.session_state["user_id"] = str(uuid.uuid4())
+    return st.session_state["user_id"]
+
+
+# ================= 1.2 用量统计 (进程级) =================
+# 汇总逻辑在 usage.py，这里负责按配置创建共享实例和从 session 取 会话 / 用户 / 剧本
+USAGE_FILE = get_config("USAGE_FILE", "usage_rollup.json")
+
+
+@st.cache_resource
+def get_usage_ledger():
+    """所有 Streamlit 会话共享同一个用量汇总，进程退出时写入剩余记录"""
+    ledger = UsageLedger(
+        USAGE_FILE,
+        load_model_prices(get_config("MODEL_PRICES")),
+        flush_interval=get_config("USAGE_FLUSH_SECONDS", 30),
+        session_retention_days=get_config("USAGE_SESSION_RETENTION_DAYS", 30),
+    )
+    atexit.register(ledger.flush)
+    return ledger
+
+
+def record_usage(mask_cfg, prompt_messages, completion_text, usage=None, kind="reply"):
+    """
+    记录一次调用的用量；usage 为上游返回的 usage 对象，缺失时本地估算。
+    统计只是附带功能，任何错误都只打日志，不会影响调用方。
+    """
+    try:
+        prompt_tokens, completion_tokens, estimated = usage_tokens(usage, prompt_messages, completion_text)
+        get_usage_ledger().record(
+            st.session_state.get("current_session_id"),
+            get_user_id(),
+            mask_cfg.get("name", "未命名剧本"),
+            mask_cfg.get("model", DEFAULT_CONFIG["model"]),
+            prompt_tokens,
+            completion_tokens,
+            estimated=estimated,
+            kind=kind,
+        )
+        print(f"DEBUG: Usage [{kind}] prompt={prompt_tokens} completion={completion_tokens}{' (estimated)' if estimated else ''}")
+    except Exception as e:
+        print(f"Usage Error: {e}")
+
+
 # ================= 2. 存档系统 =================
 def export_save_data():
     # 优先导出整个 Local Storage 中的数据
@@ -109,6 +189,7 @@ def export_save_data():
         "messages": st.session_state.messages,
 
         "long_term_memory": st.session_state.get("long_term_memory", ""),
+        "partial_reply": st.session_state.get("partial_reply", ""),
         "mask_config": st.session_state.get("mask_config", DEFAULT_CONFIG),
     }
     return json.dumps(save_data, ensure_ascii=False, indent=2)
@@ -147,6 +228,7 @@ def load_save_data(uploaded_file):
                 saved_msgs = sess.get("messages", [])
                 st.session_state.messages = system_msgs + saved_msgs
                 st.session_state["long_term_memory"] = sess.get("long_term_memory", "")
+                st.session_state["partial_reply"] = sess.get("partial_reply", "")
                 
                 st.toast(f"✅ 全局存档已加载！恢复会话: {sess.get('name', 'Unknown')}")
             else:
@@ -163,6 +245,7 @@ def load_save_data(uploaded_file):
 
         st.session_state.messages = data["messages"]
         st.session_state["long_term_memory"] = data.get("long_term_memory", "")
+        st.session_state["partial_reply"] = data.get("partial_reply", "")
         # 兼容旧存档，如果没有 config 则使用默认
         st.session_state["mask_config"] = data.get("mask_config", DEFAULT_CONFIG)
         
@@ -193,15 +276,301 @@ def summarize_memory(client, model, messages_to_summarize, current_summary):
     msgs.extend(dialogue_content)
     msgs.append({"role": "user", "content": summary_prompt})
 
+    # 总结在玩家自己的回合内同步进行，排队时同样显示位置
+    queue_notice = st.empty()
     try:
-        response = client.chat.completions.create(
-            model=model, messages=msgs, max_tokens=1000
-        )
-        return response.choices[0].message.content
+        with get_scheduler().slot(
+            endpoint_key(client),
+            get_user_id(),
+            priority=PRIORITY_BACKGROUND,
+            weight=SCHED_SUMMARY_WEIGHT,
+            on_wait=lambda pos: queue_notice.caption(f"🚦 服务器繁忙，记忆整理排队中：第 {pos} 位"),
+        ):
+            queue_notice.empty()
+            response = client.chat.completions.create(
+                model=model, messages=msgs, max_tokens=1000
+            )
+        summary = response.choices[0].message.content
     except Exception as e:
         print(f"Summary Error: {e}")  # 打印后台日志
         return current_summary
 
+    # 放在 try 之外：用量统计不能影响已经拿到的摘要
+    record_usage(
+        {**st.session_state.get("mask_config", DEFAULT_CONFIG), "model": model},
+        msgs,
+        summary,
+        usage=getattr(response, "usage", None),
+        kind="summary",
+    )
+    return summary
+
+
+# ================= 3.1 Prompt 组装 (面向上游前缀缓存) =================
+# 布局策略与前缀统计在 prompt_layout.py，这里负责从 session 取数据和记录日志
+PREFIX_CACHE_TTL = int(get_config("PREFIX_CACHE_TTL", 300))  # 秒，与多数上游的缓存保留时间相当
+
+
+def resolve_prompt_strategy(client):
+    """
+    PROMPT_STRATEGY 可以是单个策略名，也可以按上游 Base URL 分别配置，
+    例如 "deepseek.com=stable_prefix,my-proxy=legacy"，未匹配的上游使用 stable_prefix。
+    """
+    raw = str(get_config("PROMPT_STRATEGY", "stable_prefix"))
+    if "=" not in raw:
+        if raw.strip() in PROMPT_STRATEGIES:
+            return raw.strip()
+        print(f"DEBUG: Unknown PROMPT_STRATEGY {raw.strip()!r}, using stable_prefix")
+        return "stable_prefix"
+
+    base_url = endpoint_key(client)
+    for pair in raw.split(","):
+        pattern, _, name = pair.partition("=")
+        if not pattern.strip() or pattern.strip() not in base_url:
+            continue
+        if name.strip() in PROMPT_STRATEGIES:
+            return name.strip()
+        print(f"DEBUG: Unknown PROMPT_STRATEGY {name.strip()!r} for {pattern.strip()}, skipped")
+    return "stable_prefix"
+
+
+def build_prompt_messages(mask_cfg, strategy="stable_prefix"):
+    """
+    根据当前 session 组装发送给 AI 的消息列表。
+    返回 (final_messages, prefix_len)，前 prefix_len 条消息在剧本不变时逐字节稳定。
+    """
+    # 检查 mask_cfg 是否包含新字段，如果没有则尝试从文件重新加载
+    if not mask_cfg.get("glossary") and st.session_state.get("current_script"):
+        # 尝试从文件重新读取
+        refreshed = parse_nextchat_mask(st.session_state["current_script"])
+        if refreshed and refreshed.get("glossary"):
+            # 合并新字段到现有 config
+            mask_cfg["glossary"] = refreshed.get("glossary", {})
+            mask_cfg["negativeConstraints"] = refreshed.get("negativeConstraints", [])
+            mask_cfg["tailPrompt"] = refreshed.get("tailPrompt", "")
+            st.session_state["mask_config"] = mask_cfg
+            print("DEBUG: Refreshed mask_config with new fields from file")
+
+    glossary = mask_cfg.get("glossary", {})
+    neg_constraints = mask_cfg.get("negativeConstraints", [])
+    tail_prompt = mask_cfg.get("tailPrompt", "")
+    print(f"DEBUG: Glossary has {len(glossary)} entries")
+    print(f"DEBUG: negativeConstraints has {len(neg_constraints)} entries")
+    print(f"DEBUG: tailPrompt = '{tail_prompt[:50]}...' " if tail_prompt else "DEBUG: tailPrompt is empty")
+
+    final_messages, prefix_len = assemble_prompt(
+        [m for m in st.session_state.messages if m["role"] == "system"],
+        [m for m in st.session_state.messages if m["role"] != "system"],
+        long_term_memory=st.session_state["long_term_memory"],
+        glossary=glossary,
+        negative_constraints=neg_constraints,
+        tail_prompt=tail_prompt,
+        strategy=strategy,
+    )
+
+    print(f"DEBUG: Total messages to send: {len(final_messages)} (strategy={strategy}, stable prefix={prefix_len})")
+    return final_messages, prefix_len
+
+
+@st.cache_resource
+def get_prefix_stats():
+    """所有 Streamlit 会话共享前缀统计"""
+    return PrefixCacheStats(PREFIX_CACHE_TTL)
+
+
+def log_prompt_prefix(client, model, final_messages, prefix_len):
+    """
+    记录稳定前缀是否在本进程内重复出现，以及与本会话上一次请求相同的前缀长度。
+    返回是否重复 (仅为本地估计，上游实际命中以 log_provider_cache 为准)。
+    """
+    endpoint = endpoint_key(client)
+    digest, repeated = get_prefix_stats().record(endpoint, model, final_messages[:prefix_len])
+
+    # 逐条比较与上一次请求的公共前缀，反映上游可能复用的缓存长度
+    digests = [message_digest([m]) for m in final_messages]
+    previous = st.session_state.get("last_prompt_digests", [])
+    shared = 0
+    for old, new in zip(previous, digests):
+        if old != new:
+            break
+        shared += 1
+    st.session_state["last_prompt_digests"] = digests
+
+    summary = get_prefix_stats().summary(endpoint)
+
+    def fmt_ms(ms):
+        return "n/a" if ms is None else f"{ms:.0f} ms"
+
+    print(
+        f"DEBUG: Prompt prefix {digest} {'REPEAT' if repeated else 'NEW'} "
+        f"(repeat rate {summary['repeat_rate']:.0%} over {summary['requests']} requests, "
+        f"avg TTFT repeat {fmt_ms(summary['avg_ttft_repeat_ms'])} / new {fmt_ms(summary['avg_ttft_new_ms'])}), "
+        f"shared with last request: {shared}/{len(final_messages)} messages"
+    )
+    return repeated
+
+
+def log_provider_cache(client, usage):
+    """
+    记录上游 usage 中报告的缓存 token 数 (prompt_tokens_details.cached_tokens)。
+    在流式输出过程中调用，出错只打日志，不能打断回复。
+    """
+    try:
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None)
+        if usage is None or cached is None:
+            return
+        endpoint = endpoint_key(client)
+        get_prefix_stats().record_provider_cache(endpoint, usage.prompt_tokens or 0, cached)
+        ratio = get_prefix_stats().summary(endpoint)["provider_cached_ratio"]
+        overall = f"{ratio:.0%}" if ratio is not None else "n/a"
+        print(f"DEBUG: Provider cached {cached}/{usage.prompt_tokens} prompt tokens (overall {overall})")
+    except Exception as e:
+        print(f"Prefix Stats Error: {e}")
+
+
+# ================= 3.2 流式生成与断点续写 =================
+# 流式回复按节流频率写入 partial_reply 并存档，刷新或上游中断后可从断点继续 (节流逻辑见 streaming.py)。
+# 每次存档都会序列化整个 storage_data (所有会话的全部消息) 并挂载一个新的 LocalStorage 组件，
+# 代价不小：默认以时间为主要触发条件，且距上次存档新增不足 CHECKPOINT_MIN_CHARS 字时不存。
+CHECKPOINT_MS = int(get_config("CHECKPOINT_MS", 5000))  # 每 T 毫秒
+CHECKPOINT_CHUNKS = int(get_config("CHECKPOINT_CHUNKS", 500))  # 或每 N 个流式分块 (约等于 token 数)，输出极快时兜底
+CHECKPOINT_MIN_CHARS = int(get_config("CHECKPOINT_MIN_CHARS", 200))  # 两次存档之间至少新增的字数
+
+RESUME_PROMPT = "【续写】上一条回复在中途被打断。请从断点处紧接着继续输出，不要重复已写出的内容，也不要添加任何说明。"
+
+
+def save_checkpoint(text):
+    """checkpointed_stream 的存档回调：写入 partial_reply 并存入 Local Storage"""
+    st.session_state["partial_reply"] = text
+    save_to_local_storage()
+
+
+def keep_partial_reply(text):
+    """checkpointed_stream 结束时的回调：内存中保留完整的已生成内容"""
+    st.session_state["partial_reply"] = text
+
+
+@st.cache_resource
+def get_stream_usage_unsupported():
+    """不支持 stream_options 的 Endpoint (进程级，所有会话共享)"""
+    return set()
+
+
+def create_stream(client, request_args):
+    """
+    发起流式请求，并通过 stream_options 请求上游在末尾返回 usage 分块。
+    不支持该参数的 Endpoint 会被记住，之后直接不带该参数请求 (用量改为本地估算)。
+    STREAM_INCLUDE_USAGE=0 可全局关闭。
+    """
+    unsupported = get_stream_usage_unsupported()
+    endpoint = endpoint_key(client)
+    if str(get_config("STREAM_INCLUDE_USAGE", "1")) == "0" or endpoint in unsupported:
+        return client.chat.completions.create(**request_args)
+
+    try:
+        return client.chat.completions.create(**request_args, stream_options={"include_usage": True})
+    except BadRequestError as e:
+        # 只有错误信息明确指向 stream_options 时才重试 (上下文超长等其他 400 错误照常抛出)；
+        # 每个 Endpoint 最多重试一次，之后直接不带该参数请求
+        message = str(e).lower()
+        if "stream_options" not in message and "include_usage" not in message:
+            raise
+        stream = client.chat.completions.create(**request_args)
+        print(f"DEBUG: {endpoint} rejected stream_options, falling back to estimation: {e}")
+        unsupported.add(endpoint)
+        return stream
+
+
+def generate_reply(client, mask_cfg, final_messages, prefix_len=0, partial=""):
+    """
+    流式生成 GM 回复；partial 非空时为断点续写，新内容接在 partial 之后。
+    prefix_len 为 build_prompt_messages 返回的稳定前缀长度，用于统计前缀缓存命中。
+    """
+    prefix_repeated = log_prompt_prefix(client, mask_cfg["model"], final_messages, prefix_len)
+    if partial:
+        final_messages = final_messages + [
+            {"role": "assistant", "content": partial},
+            {"role": "system", "content": RESUME_PROMPT},
+        ]
+    st.session_state["partial_reply"] = partial
+    kind = "resume" if partial else "reply"
+    usage_holder = []
+    reply_stream = None
+    recorded = False
+
+    try:
+        with st.chat_message("assistant", avatar="🤖"):
+            if partial:
+                st.markdown(partial)
+            queue_notice = st.empty()
+            with st.spinner("⏳ GM 正在构思..."), get_scheduler().slot(
+                endpoint_key(client),
+                get_user_id(),
+                priority=PRIORITY_INTERACTIVE,
+                weight=SCHED_REPLY_WEIGHT,
+                on_wait=lambda pos: queue_notice.caption(f"🚦 服务器繁忙，排队中：第 {pos} 位"),
+            ):
+                queue_notice.empty()
+                started = time.monotonic()
+
+                def on_first_token():
+                    ttft_ms = (time.monotonic() - started) * 1000
+                    get_prefix_stats().record_ttft(endpoint_key(client), prefix_repeated, ttft_ms)
+                    print(f"DEBUG: TTFT {ttft_ms:.0f} ms (prefix {'REPEAT' if prefix_repeated else 'NEW'})")
+
+                def on_usage(usage):
+                    usage_holder.append(usage)
+                    log_provider_cache(client, usage)
+
+                request_args = dict(
+                    model=mask_cfg["model"],
+                    messages=final_messages,
+                    stream=True,
+                    temperature=mask_cfg["temperature"],
+                    top_p=mask_cfg["top_p"],
+                    max_tokens=mask_cfg["max_tokens"],
+                    presence_penalty=mask_cfg["presence_penalty"],
+                    frequency_penalty=mask_cfg["frequency_penalty"],
+                )
+                reply_stream = checkpointed_stream(
+                    create_stream(client, request_args),
+                    partial,
+                    on_checkpoint=save_checkpoint,
+                    on_close=keep_partial_reply,
+                    on_first_token=on_first_token,
+                    on_usage=on_usage,
+                    every_ms=CHECKPOINT_MS,
+                    every_chunks=CHECKPOINT_CHUNKS,
+                    min_chars=CHECKPOINT_MIN_CHARS,
+                )
+                st.write_stream(reply_stream)
+
+        response = st.session_state["partial_reply"]
+        st.session_state["partial_reply"] = ""
+        st.session_state.messages.append({"role": "assistant", "content": response})
+        recorded = True
+        record_usage(mask_cfg, final_messages, response[len(partial):], usage_holder[-1] if usage_holder else None, kind)
+        # 保存 AI 回复
+        save_to_local_storage()
+
+    except UserQuotaExceeded as e:
+        st.warning(f"🚦 {e}")
+
+    except Exception as e:
+        # 保留已生成的部分，之后可点击"继续生成"
+        if st.session_state.get("partial_reply"):
+            save_to_local_storage()
+        st.error(f"API 请求失败: {e}")
+
+    finally:
+        # 上游出错，或刷新页面 / rerun 打断了流 (StopException、RerunException 继承自 BaseException)，
+        # 已生成的部分同样消耗了 token
+        if reply_stream is not None and not recorded:
+            reply_stream.close()  # 触发 checkpointed_stream 的 finally：关闭上游流，partial_reply 包含全部已收到的内容
+            generated = st.session_state.get("partial_reply", "")[len(partial):]
+            record_usage(mask_cfg, final_messages, generated, usage_holder[-1] if usage_holder else None, kind)
+
 
 # ================= 4. Mask 解析器 =================
 def parse_nextchat_mask(file_path):
@@ -314,6 +683,8 @@ def load_from_local_storage():
                         st.session_state.messages = sess.get("messages", copy.deepcopy(DEFAULT_CONFIG["initial_messages"]))
 
                     st.session_state["long_term_memory"] = sess.get("long_term_memory", "")
+                    # 未完成的流式回复 (刷新/断线前的最后一次断点)
+                    st.session_state["partial_reply"] = sess.get("partial_reply", "")
 
                     st.toast(f"已恢复会话: {sess.get('name', 'Unknown')}")
             except Exception as e:
@@ -347,6 +718,8 @@ def save_to_local_storage():
         st.session_state["storage_data"] = {"sessions": {}, "current_session_id": session_id}
 
     sessions = st.session_state["storage_data"]["sessions"]
+    # 用量统计中的用户标识，随存档持久化
+    st.session_state["storage_data"].setdefault("user_id", get_user_id())
 
     # 提取对话摘要作为标题
     name = "新会话"
@@ -367,6 +740,7 @@ def save_to_local_storage():
         "timestamp": time.time(),
         "messages": user_messages,  # 只保存对话，不包含 system prompt
         "long_term_memory": st.session_state.get("long_term_memory", ""),
+        "partial_reply": st.session_state.get("partial_reply", ""),  # 流式回复断点
         "current_script": st.session_state.get("current_script")
     }
     st.session_state["storage_data"]["current_session_id"] = session_id
@@ -402,6 +776,7 @@ def create_new_session():
 
     st.session_state.messages = copy.deepcopy(config_to_use.get("initial_messages", DEFAULT_CONFIG["initial_messages"]))
     st.session_state["long_term_memory"] = ""
+    st.session_state["partial_reply"] = ""
     st.session_state["mask_config"] = copy.deepcopy(config_to_use)
 
     return new_id
@@ -425,6 +800,7 @@ def switch_session(session_id):
             st.session_state["current_session_id"] = session_id
             st.session_state.messages = sess.get("messages", [])
             st.session_state["long_term_memory"] = sess.get("long_term_memory", "")
+            st.session_state["partial_reply"] = sess.get("partial_reply", "")
             st.session_state["mask_config"] = sess.get("mask_config", DEFAULT_CONFIG)
             save_to_local_storage() # 更新 timestamp
             st.rerun()
@@ -439,6 +815,8 @@ if "messages" not in st.session_state:
     st.session_state.messages = copy.deepcopy(DEFAULT_CONFIG["initial_messages"])
 if "long_term_memory" not in st.session_state:
     st.session_state["long_term_memory"] = ""
+if "partial_reply" not in st.session_state:
+    st.session_state["partial_reply"] = ""
 if "mask_config" not in st.session_state:
     st.session_state["mask_config"] = copy.deepcopy(DEFAULT_CONFIG)
 if "current_session_id" not in st.session_state:
@@ -511,6 +889,7 @@ with st.sidebar:
                     config_data["initial_messages"]
                 )
                 st.session_state["long_term_memory"] = ""
+                st.session_state["partial_reply"] = ""
                 st.success(f"已装载: {config_data['name']}")
                 save_to_local_storage() # 加载剧本也自动保存
                 time.sleep(0.5)
@@ -579,6 +958,37 @@ with st.sidebar:
         )
         st.caption("注：这会导出当前所有会话历史")
 
+    # --- 📊 用量统计 ---
+    with st.expander("📊 用量统计", expanded=False):
+        ledger = get_usage_ledger()
+        for label, bucket, key in [
+            ("本会话", "sessions", st.session_state.get("current_session_id")),
+            (f"剧本: {st.session_state['mask_config'].get('name', '未命名剧本')}", "masks", st.session_state["mask_config"].get("name", "未命名剧本")),
+            ("我的全部会话", "users", get_user_id()),
+        ]:
+            usage = ledger.get(bucket, key)
+            if not usage:
+                st.caption(f"{label}：暂无记录")
+                continue
+            estimated = f"，其中 {usage['estimated_requests']} 次为估算" if usage["estimated_requests"] else ""
+            st.caption(
+                f"**{label}**：{usage['requests']} 次请求{estimated}  \n"
+                f"输入 {usage['prompt_tokens']:,} / 输出 {usage['completion_tokens']:,} tokens"
+                + (f"  \n费用约 ${usage['cost']:.4f}" if usage["cost"] else "")
+            )
+
+        # 导出内容只在打开开关后生成；默认只导出自己的用量，
+        # 配置了 USAGE_ADMIN_KEY 时输入正确的管理密钥可导出全部用户
+        if st.toggle("导出用量统计", key="usage_export_open"):
+            admin_key = get_config("USAGE_ADMIN_KEY")
+            is_admin = bool(admin_key) and st.text_input("管理密钥 (可选)", type="password") == admin_key
+            st.download_button(
+                label="⬇️ 导出全部用户用量" if is_admin else "⬇️ 导出我的用量",
+                data=ledger.export() if is_admin else ledger.export(user_id=get_user_id()),
+                file_name=f"Usage_{datetime.now().strftime('%Y%m%d')}.json",
+                mime="application/json",
+            )
+
 # ================= 6. 主聊天界面 =================
 mask_cfg = st.session_state.get("mask_config", {})
 st.title(f"{mask_cfg.get('name', '暗夜刀锋 GM')}")
@@ -603,8 +1013,40 @@ for msg in st.session_state.messages:
     with st.chat_message(msg["role"], avatar=avatar):
         st.markdown(msg["content"])
 
+# 未完成的回复 (刷新或上游中断)：显示已生成部分，可从断点继续
+# 按钮回调只改状态，侧边栏每次 rerun 都会自动保存
+def accept_partial_reply():
+    st.session_state.messages.append({"role": "assistant", "content": st.session_state["partial_reply"]})
+    st.session_state["partial_reply"] = ""
+
+
+def discard_partial_reply():
+    st.session_state["partial_reply"] = ""
+
+
+def request_resume():
+    st.session_state["resume_partial"] = True
+
+
+if st.session_state.pop("resume_partial", False) and st.session_state.get("partial_reply"):
+    mask_cfg = st.session_state["mask_config"]
+    final_messages, prefix_len = build_prompt_messages(mask_cfg, resolve_prompt_strategy(client))
+    generate_reply(client, mask_cfg, final_messages, prefix_len, partial=st.session_state["partial_reply"])
+elif st.session_state.get("partial_reply"):
+    with st.chat_message("assistant", avatar="🤖"):
+        st.markdown(st.session_state["partial_reply"])
+        st.caption(f"⚠️ 这条回复未完成 (已生成 {len(st.session_state['partial_reply'])} 字)")
+        col_a, col_b, col_c = st.columns(3)
+        col_a.button("▶️ 继续生成", use_container_width=True, on_click=request_resume)
+        col_b.button("✅ 保留现有内容", use_container_width=True, on_click=accept_partial_reply)
+        col_c.button("🗑️ 丢弃", use_container_width=True, on_click=discard_partial_reply)
+
 # 处理用户输入
 if prompt := st.chat_input("描述你的行动..."):
+    # 未完成的回复直接保留为正文，保证对话上下文连贯
+    if st.session_state.get("partial_reply"):
+        accept_partial_reply()
+
     # 1. 显示用户输入
     st.session_state.messages.append({"role": "user", "content": prompt})
     with st.chat_message("user", avatar="👤"):
@@ -662,80 +1104,7 @@ if prompt := st.chat_input("描述你的行动..."):
             save_to_local_storage()
 
     # --- 构建最终 Prompt ---
-    final_messages = []
-
-    # (1) 先放入所有的原始 System Prompt
-    final_messages.extend(system_msgs)
-
-    # 插入长期记忆
-    if st.session_state["long_term_memory"]:
-        final_messages.append(
-            {
-                "role": "system",
-                "content": f"【前情提要 / Long Term Memory】\n{st.session_state['long_term_memory']}",
-            }
-        )
-
-    # 插入最近对话 (过滤掉骰子的 HTML 标记，只保留 content 用于推理)
-    for m in st.session_state.messages[1:]:
-        clean_msg = {"role": m["role"], "content": m["content"]}
-        final_messages.append(clean_msg)
-
-    # --- 注入扩展字段 (最后注入以增强效果) ---
-
-    # 检查 mask_cfg 是否包含新字段，如果没有则尝试从文件重新加载
-    if not mask_cfg.get("glossary") and st.session_state.get("current_script"):
-        # 尝试从文件重新读取
-        refreshed = parse_nextchat_mask(st.session_state["current_script"])
-        if refreshed and refreshed.get("glossary"):
-            # 合并新字段到现有 config
-            mask_cfg["glossary"] = refreshed.get("glossary", {})
-            mask_cfg["negativeConstraints"] = refreshed.get("negativeConstraints", [])
-            mask_cfg["tailPrompt"] = refreshed.get("tailPrompt", "")
-            st.session_state["mask_config"] = mask_cfg
-            print("DEBUG: Refreshed mask_config with new fields from file")
-
-    # (A) 术语对照表 (Glossary)
-    glossary = mask_cfg.get("glossary", {})
-    print(f"DEBUG: Glossary has {len(glossary)} entries")
-    if glossary:
-        glossary_text = "【术语对照 / Glossary】\n" + "\n".join([f"- {en}: {zh}" for en, zh in glossary.items()])
-        final_messages.append({"role": "system", "content": glossary_text})
-
-    # (B) 负面约束 (Negative Constraints)
-    neg_constraints = mask_cfg.get("negativeConstraints", [])
-    print(f"DEBUG: negativeConstraints has {len(neg_constraints)} entries")
-    if neg_constraints:
-        constraints_text = "【禁止事项 / Negative Constraints】\n" + "\n".join([f"❌ {c}" for c in neg_constraints])
-        final_messages.append({"role": "system", "content": constraints_text})
-
-    # (C) 尾部指令 (Tail Prompt) - 最后注入
-    tail_prompt = mask_cfg.get("tailPrompt", "")
-    print(f"DEBUG: tailPrompt = '{tail_prompt[:50]}...' " if tail_prompt else "DEBUG: tailPrompt is empty")
-    if tail_prompt:
-        final_messages.append({"role": "system", "content": tail_prompt})
-
-    print(f"DEBUG: Total messages to send: {len(final_messages)}")
+    final_messages, prefix_len = build_prompt_messages(mask_cfg, resolve_prompt_strategy(client))
 
     # 3. AI 生成回复
-    try:
-        with st.chat_message("assistant", avatar="🤖"):
-            with st.spinner("⏳ GM 正在构思..."):
-                stream = client.chat.completions.create(
-                    model=mask_cfg["model"],
-                    messages=final_messages,
-                    stream=True,
-                    temperature=mask_cfg["temperature"],
-                    top_p=mask_cfg["top_p"],
-                    max_tokens=mask_cfg["max_tokens"],
-                    presence_penalty=mask_cfg["presence_penalty"],
-                    frequency_penalty=mask_cfg["frequency_penalty"],
-                )
-                response = st.write_stream(stream)
-
-        st.session_state.messages.append({"role": "assistant", "content": response})
-        # 保存 AI 回复
-        save_to_local_storage()
-
-    except Exception as e:
-        st.error(f"API 请求失败: {e}")
+    generate_reply(client, mask_cfg, final_messages, prefix_len)
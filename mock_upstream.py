@@ -0,0 +1,173 @@
+"""
+本地模拟上游 (不依赖 Streamlit / openai)，用于测试调度器等组件。
+
+MockOpenAIClient 提供与 openai.OpenAI 相同形状的 client.chat.completions.create()：
+- 支持 stream=True / False，以及 stream_options={"include_usage": True}
+- 按滑动窗口限流，超限时抛出 RateLimitExceeded (相当于 HTTP 429)
+- 记录同时进行中的请求峰值，便于验证并发上限
+- 可选的前缀缓存模拟：按消息边界缓存请求前缀，命中部分在 usage.prompt_tokens_details.cached_tokens
+  中报告，并按延迟模型计算首字延迟 (TTFT)，用于比较不同 Prompt 布局
+"""
+import collections
+import hashlib
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+
+class RateLimitExceeded(Exception):
+    """模拟上游返回的 429"""
+
+    status_code = 429
+
+
+class MockOpenAIClient:
+    """
+    - max_requests / window: 每 window 秒最多 max_requests 个请求 (max_requests 为 None 不限流)
+    - reply: 固定的回复内容，流式时按字逐块返回
+    - chunk_delay: 流式每块之间的间隔秒数
+    - prefix_cache: 是否模拟上游前缀缓存；cache_ttl 为缓存保留秒数，
+      min_cache_tokens 为可缓存前缀的最小 token 数 (如 OpenAI 为 1024)
+    - base_latency / uncached_token_latency / cached_token_latency: TTFT 延迟模型 (秒)，
+      TTFT = base + 未命中 token 数 * uncached + 命中 token 数 * cached；
+      simulate_latency=True 时真实 sleep，否则只记录到 ttft_log
+    """
+
+    def __init__(
+        self,
+        max_requests=None,
+        window=60.0,
+        reply="收到。",
+        chunk_delay=0.0,
+        base_url="http://mock-upstream/v1/",
+        prefix_cache=False,
+        cache_ttl=300.0,
+        min_cache_tokens=0,
+        base_latency=0.2,
+        uncached_token_latency=0.0005,
+        cached_token_latency=0.00005,
+        simulate_latency=False,
+    ):
+        self.base_url = base_url
+        self.max_requests = max_requests
+        self.window = window
+        self.reply = reply
+        self.chunk_delay = chunk_delay
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+        self.prefix_cache = prefix_cache
+        self.cache_ttl = cache_ttl
+        self.min_cache_tokens = min_cache_tokens
+        self.base_latency = base_latency
+        self.uncached_token_latency = uncached_token_latency
+        self.cached_token_latency = cached_token_latency
+        self.simulate_latency = simulate_latency
+        self._cache = {}  # 前缀哈希 -> 最近一次使用时间
+        self.ttft_log = []  # 每次请求的 {"prompt_tokens", "cached_tokens", "ttft"}
+
+        self._lock = threading.Lock()
+        self._recent = collections.deque()  # 窗口内已接受请求的时间
+        self.accepted = 0
+        self.rejected = 0
+        self.active = 0
+        self.peak_active = 0
+
+    def _admit(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0] >= self.window:
+                self._recent.popleft()
+            if self.max_requests is not None and len(self._recent) >= self.max_requests:
+                self.rejected += 1
+                raise RateLimitExceeded(f"429: more than {self.max_requests} requests in {self.window}s")
+            self._recent.append(now)
+            self.accepted += 1
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+
+    def _finish(self):
+        with self._lock:
+            self.active -= 1
+
+    @staticmethod
+    def _tokens(message):
+        # 模拟环境下 1 个字符记作 1 个 token
+        return len(str(message["content"]))
+
+    def _lookup_prefix(self, model, messages):
+        """返回命中缓存的前缀 token 数，并把本次请求的各级前缀写入缓存"""
+        if not self.prefix_cache:
+            return 0
+
+        digest = hashlib.sha256(model.encode("utf-8"))
+        boundaries = []  # (到该条消息为止的前缀哈希, 前缀 token 数)
+        tokens = 0
+        for m in messages:
+            digest.update(json.dumps(m, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+            tokens += self._tokens(m)
+            boundaries.append((digest.hexdigest(), tokens))
+
+        now = time.monotonic()
+        cached = 0
+        with self._lock:
+            for k in [k for k, t in self._cache.items() if now - t > self.cache_ttl]:
+                del self._cache[k]
+            for key, n in boundaries:
+                if key in self._cache and n >= self.min_cache_tokens:
+                    cached = n
+                self._cache[key] = now
+        return cached
+
+    def _prefill(self, model, messages):
+        """计算缓存命中和 TTFT，返回 usage 中的 prompt 部分"""
+        prompt_tokens = sum(self._tokens(m) for m in messages)
+        cached = self._lookup_prefix(model, messages)
+        ttft = (
+            self.base_latency
+            + (prompt_tokens - cached) * self.uncached_token_latency
+            + cached * self.cached_token_latency
+        )
+        with self._lock:
+            self.ttft_log.append({"prompt_tokens": prompt_tokens, "cached_tokens": cached, "ttft": ttft})
+        if self.simulate_latency:
+            time.sleep(ttft)
+        return prompt_tokens, cached
+
+    def _usage(self, prompt_tokens, cached, completion):
+        return SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=len(completion),
+            total_tokens=prompt_tokens + len(completion),
+            prompt_tokens_details=SimpleNamespace(cached_tokens=cached),
+        )
+
+    def _create(self, model, messages, stream=False, stream_options=None, **kwargs):
+        self._admit()
+        if not stream:
+            try:
+                prompt_tokens, cached = self._prefill(model, messages)
+                time.sleep(self.chunk_delay * len(self.reply))
+                return SimpleNamespace(
+                    model=model,
+                    choices=[SimpleNamespace(message=SimpleNamespace(role="assistant", content=self.reply))],
+                    usage=self._usage(prompt_tokens, cached, self.reply),
+                )
+            finally:
+                self._finish()
+        return self._stream(model, messages, bool(stream_options and stream_options.get("include_usage")))
+
+    def _stream(self, model, messages, include_usage):
+        try:
+            prompt_tokens, cached = self._prefill(model, messages)
+            for ch in self.reply:
+                if self.chunk_delay:
+                    time.sleep(self.chunk_delay)
+                yield SimpleNamespace(
+                    choices=[SimpleNamespace(delta=SimpleNamespace(content=ch))],
+                    usage=None,
+                )
+            if include_usage:
+                yield SimpleNamespace(choices=[], usage=self._usage(prompt_tokens, cached, self.reply))
+        finally:
+            self._finish()
@@ -0,0 +1,142 @@
+"""
+GM 请求的 Prompt 布局与前缀统计 (不依赖 Streamlit，可单独导入测试)。
+
+stable_prefix: 剧本 System + 术语表 + 禁止事项 在最前 (字节稳定)，
+               之后依次是 前情提要 (仅压缩时变化)、对话 (逐轮追加)、尾部指令
+legacy:        旧顺序，前情提要紧跟 System，术语表/禁止事项/尾部指令都放在对话之后
+"""
+import hashlib
+import json
+import threading
+import time
+
+PROMPT_STRATEGIES = ("stable_prefix", "legacy")
+
+
+def assemble_prompt(
+    system_msgs,
+    chat_msgs,
+    long_term_memory="",
+    glossary=None,
+    negative_constraints=None,
+    tail_prompt="",
+    strategy="stable_prefix",
+):
+    """
+    按策略拼装最终消息列表。
+    返回 (final_messages, prefix_len)，前 prefix_len 条消息在剧本不变时逐字节稳定。
+    """
+    # 只保留 role / content，去掉骰子等自定义字段
+    system_msgs = [{"role": m["role"], "content": m["content"]} for m in system_msgs]
+    chat_msgs = [{"role": m["role"], "content": m["content"]} for m in chat_msgs]
+
+    # 长期记忆
+    memory_msgs = []
+    if long_term_memory:
+        memory_msgs.append(
+            {
+                "role": "system",
+                "content": f"【前情提要 / Long Term Memory】\n{long_term_memory}",
+            }
+        )
+
+    # (A) 术语对照表 (Glossary)
+    glossary_msgs = []
+    if glossary:
+        glossary_text = "【术语对照 / Glossary】\n" + "\n".join([f"- {en}: {zh}" for en, zh in glossary.items()])
+        glossary_msgs.append({"role": "system", "content": glossary_text})
+
+    # (B) 负面约束 (Negative Constraints)
+    constraint_msgs = []
+    if negative_constraints:
+        constraints_text = "【禁止事项 / Negative Constraints】\n" + "\n".join([f"❌ {c}" for c in negative_constraints])
+        constraint_msgs.append({"role": "system", "content": constraints_text})
+
+    # (C) 尾部指令 (Tail Prompt) - 始终紧贴最新一轮对话
+    tail_msgs = []
+    if tail_prompt:
+        tail_msgs.append({"role": "system", "content": tail_prompt})
+
+    if strategy == "legacy":
+        prefix = system_msgs
+        final_messages = prefix + memory_msgs + chat_msgs + glossary_msgs + constraint_msgs + tail_msgs
+    else:
+        prefix = system_msgs + glossary_msgs + constraint_msgs
+        final_messages = prefix + memory_msgs + chat_msgs + tail_msgs
+    return final_messages, len(prefix)
+
+
+def message_digest(messages):
+    """消息列表的稳定哈希 (与上游看到的序列化内容一致)"""
+    raw = json.dumps(messages, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+class PrefixCacheStats:
+    """
+    按 Endpoint 统计前缀复用情况：
+    - repeat_rate: 本进程在 ttl 内是否发送过相同的稳定前缀 (本地估计，不等于上游缓存命中)
+    - provider_cached_ratio: 上游 usage.prompt_tokens_details.cached_tokens 报告的实际缓存比例
+    - 前缀重复 / 未重复时的平均首字延迟 (TTFT)
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._seen = {}  # (endpoint, model, digest) -> 最近一次出现的时间
+        self._totals = {}
+
+    def _endpoint_totals(self, endpoint):
+        return self._totals.setdefault(
+            endpoint,
+            {
+                "requests": 0, "repeats": 0,
+                "ttft_repeat_ms": 0.0, "ttft_repeat_n": 0, "ttft_new_ms": 0.0, "ttft_new_n": 0,
+                "reported_prompt_tokens": 0, "reported_cached_tokens": 0,
+            },
+        )
+
+    def record(self, endpoint, model, prefix_messages):
+        """记录一次请求的稳定前缀，返回 (digest, 是否在 ttl 内重复)"""
+        digest = message_digest(prefix_messages)
+        now = time.monotonic()
+        with self._lock:
+            key = (endpoint, model, digest)
+            repeated = key in self._seen and now - self._seen[key] <= self.ttl
+            self._seen[key] = now
+            for k in [k for k, t in self._seen.items() if now - t > self.ttl]:
+                del self._seen[k]
+
+            totals = self._endpoint_totals(endpoint)
+            totals["requests"] += 1
+            totals["repeats"] += int(repeated)
+        return digest, repeated
+
+    def record_ttft(self, endpoint, repeated, ttft_ms):
+        with self._lock:
+            totals = self._endpoint_totals(endpoint)
+            kind = "repeat" if repeated else "new"
+            totals[f"ttft_{kind}_ms"] += ttft_ms
+            totals[f"ttft_{kind}_n"] += 1
+
+    def record_provider_cache(self, endpoint, prompt_tokens, cached_tokens):
+        """记录上游 usage 中报告的缓存 token 数"""
+        with self._lock:
+            totals = self._endpoint_totals(endpoint)
+            totals["reported_prompt_tokens"] += prompt_tokens
+            totals["reported_cached_tokens"] += cached_tokens
+
+    def summary(self, endpoint):
+        with self._lock:
+            t = dict(self._totals.get(endpoint, {}))
+        if not t:
+            return {}
+        return {
+            "requests": t["requests"],
+            "repeat_rate": t["repeats"] / t["requests"] if t["requests"] else 0.0,
+            "provider_cached_ratio": (
+                t["reported_cached_tokens"] / t["reported_prompt_tokens"] if t["reported_prompt_tokens"] else None
+            ),
+            "avg_ttft_repeat_ms": t["ttft_repeat_ms"] / t["ttft_repeat_n"] if t["ttft_repeat_n"] else None,
+            "avg_ttft_new_ms": t["ttft_new_ms"] / t["ttft_new_n"] if t["ttft_new_n"] else None,
+        }
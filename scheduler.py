@@ -0,0 +1,204 @@
+"""
+进程级请求调度器 (不依赖 Streamlit，可单独导入测试)。
+
+所有会话共享同一个调度器：每个 Endpoint 限制并发 + 令牌桶限速，
+同一 Endpoint 内按用户做加权公平排队并限制每个用户的配额，交互回复优先于后台总结。
+"""
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+PRIORITY_INTERACTIVE = 0  # GM 回复
+PRIORITY_BACKGROUND = 1  # 记忆总结等后台任务
+
+
+class UserQuotaExceeded(Exception):
+    """同一用户排队中的请求超过配额"""
+
+
+class TokenBucket:
+    """令牌桶：rate 为每秒补充的令牌数，capacity 为突发上限；rate <= 0 表示不限速"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """距离下一个令牌可用的秒数，0 表示可立即取用"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        if self.rate <= 0:
+            return
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Ticket:
+    __slots__ = ("user", "priority", "start", "finish", "seq", "enqueued")
+
+    def __init__(self, user, priority, start, finish, seq):
+        self.user = user
+        self.priority = priority
+        self.start = start
+        self.finish = finish
+        self.seq = seq
+        self.enqueued = time.monotonic()
+
+    def order(self, now, aging_seconds):
+        """
+        先按优先级，再按虚拟完成时间 (WFQ)，最后按到达顺序。
+        每排队 aging_seconds 秒优先级提升一级，低优先级请求不会被持续的高优先级请求饿死。
+        """
+        priority = self.priority
+        if aging_seconds > 0:
+            priority = max(PRIORITY_INTERACTIVE, priority - int((now - self.enqueued) // aging_seconds))
+        return (priority, self.finish, self.seq)
+
+
+class _EndpointQueue:
+    def __init__(self, max_concurrency, rate, burst):
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.waiting = []
+        self.bucket = TokenBucket(rate, burst)
+        self.virtual_clock = 0.0
+        self.user_finish = {}  # user -> 该用户最后一个请求的虚拟完成时间
+        self.user_active = {}  # user -> 该用户进行中的请求数
+
+
+class RequestScheduler:
+    """
+    进程级公平调度器，所有上游请求都应包在 slot() 里。
+    - max_concurrency: 每个 Endpoint 同时进行的请求上限
+    - rate_per_min / burst: 每个 Endpoint 的令牌桶限速 (rate_per_min <= 0 不限速)
+    - aging_seconds: 低优先级请求每排队这么久提升一级优先级 (<= 0 为严格优先级)
+    - max_active_per_user: 每个用户在同一 Endpoint 上同时进行的请求上限，
+      达到上限时该用户的请求让位给其他用户
+    - max_queued_per_user: 每个用户在同一 Endpoint 上排队的请求上限，超出时抛出 UserQuotaExceeded
+    """
+
+    def __init__(
+        self,
+        max_concurrency=4,
+        rate_per_min=0,
+        burst=None,
+        aging_seconds=5.0,
+        max_active_per_user=2,
+        max_queued_per_user=4,
+    ):
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self.rate = float(rate_per_min) / 60.0
+        self.burst = int(burst) if burst else self.max_concurrency
+        self.aging_seconds = float(aging_seconds)
+        self.max_active_per_user = max(int(max_active_per_user), 1)
+        self.max_queued_per_user = max(int(max_queued_per_user), 1)
+        self._cond = threading.Condition()
+        self._endpoints = {}
+        self._seq = itertools.count()
+
+    def _queue(self, endpoint):
+        if endpoint not in self._endpoints:
+            self._endpoints[endpoint] = _EndpointQueue(self.max_concurrency, self.rate, self.burst)
+        return self._endpoints[endpoint]
+
+    def _ordered(self, q):
+        now = time.monotonic()
+        return sorted(q.waiting, key=lambda t: t.order(now, self.aging_seconds))
+
+    def queue_position(self, endpoint, ticket):
+        """1 表示排在队首"""
+        return self._ordered(self._queue(endpoint)).index(ticket) + 1
+
+    def _next_eligible(self, q):
+        """排在最前、且所属用户未达到并发配额的请求"""
+        for t in self._ordered(q):
+            if q.user_active.get(t.user, 0) < self.max_active_per_user:
+                return t
+        return None
+
+    def stats(self):
+        with self._cond:
+            return {
+                ep: {"active": q.active, "waiting": len(q.waiting)}
+                for ep, q in self._endpoints.items()
+            }
+
+    @contextmanager
+    def slot(self, endpoint, user, priority=PRIORITY_INTERACTIVE, weight=1.0, on_wait=None):
+        """
+        阻塞直到轮到该请求，退出时归还并发名额。
+        user 为公平排队和配额的单位；weight 越大，该请求占用的虚拟时间越少 (份额越大)。
+        on_wait(position) 在排队位置变化时被调用 (不持有锁)，可用于在界面上显示队列位置。
+        """
+        with self._cond:
+            q = self._queue(endpoint)
+            queued = sum(1 for t in q.waiting if t.user == user)
+            if queued >= self.max_queued_per_user:
+                raise UserQuotaExceeded(f"排队中的请求过多 ({queued})，请等待之前的请求完成")
+            start = max(q.virtual_clock, q.user_finish.get(user, 0.0))
+            finish = start + 1.0 / max(weight, 1e-6)
+            q.user_finish[user] = finish
+            ticket = _Ticket(user, priority, start, finish, next(self._seq))
+            q.waiting.append(ticket)
+
+        granted = False
+        try:
+            last_pos = None
+            with self._cond:
+                while True:
+                    pos = self.queue_position(endpoint, ticket)
+                    delay = None
+                    if q.active < q.max_concurrency and self._next_eligible(q) is ticket:
+                        now = time.monotonic()
+                        delay = q.bucket.wait_time(now)
+                        if delay == 0:
+                            q.waiting.remove(ticket)
+                            q.active += 1
+                            q.user_active[user] = q.user_active.get(user, 0) + 1
+                            q.bucket.take(now)
+                            q.virtual_clock = max(q.virtual_clock, ticket.start)
+                            granted = True
+                            self._cond.notify_all()
+                            break
+
+                    if on_wait and pos != last_pos:
+                        last_pos = pos
+                        self._cond.release()
+                        try:
+                            on_wait(pos)
+                        finally:
+                            self._cond.acquire()
+                        continue
+
+                    # 限速时按令牌补充时间唤醒，否则等待其他请求释放
+                    self._cond.wait(timeout=delay if delay else 1.0)
+
+            yield
+        finally:
+            with self._cond:
+                if granted:
+                    q.active -= 1
+                    q.user_active[user] -= 1
+                    if not q.user_active[user]:
+                        del q.user_active[user]
+                elif ticket in q.waiting:
+                    q.waiting.remove(ticket)
+                # 清理已无排队请求且已被虚拟时钟追上的用户
+                pending = {t.user for t in q.waiting}
+                for u in [u for u, f in q.user_finish.items() if u not in pending and f <= q.virtual_clock]:
+                    del q.user_finish[u]
+                self._cond.notify_all()
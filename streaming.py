@@ -0,0 +1,60 @@
+"""
+流式回复的断点存档 (不依赖 Streamlit，可单独导入测试)。
+
+checkpointed_stream 包装上游流，逐块产出文本，并按节流频率把已生成内容交给 on_checkpoint 存档，
+刷新或上游中断后可从断点继续。
+"""
+import time
+
+
+def checkpointed_stream(
+    stream,
+    prefix="",
+    on_checkpoint=None,
+    on_close=None,
+    on_first_token=None,
+    on_usage=None,
+    every_ms=5000,
+    every_chunks=500,
+    min_chars=200,
+):
+    """
+    包装上游流给 st.write_stream 使用：逐块产出文本，
+    每 every_ms 毫秒或 every_chunks 块 (且距上次存档新增至少 min_chars 字)
+    调用 on_checkpoint(已生成内容) 存档，新内容接在 prefix 之后。
+    on_close(已生成内容) 在流结束、出错或被关闭时调用，此时上游流也会被关闭。
+    on_first_token() 在收到第一段文本时调用 (用于统计 TTFT)，
+    on_usage(usage) 在收到上游的 usage 分块时调用。
+    """
+    parts = [prefix]
+    pending = 0
+    pending_chars = 0
+    last_save = time.monotonic()
+    try:
+        for chunk in stream:
+            if on_usage and getattr(chunk, "usage", None):
+                on_usage(chunk.usage)
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            if on_first_token and len(parts) == 1:
+                on_first_token()
+            parts.append(delta)
+            pending += 1
+            pending_chars += len(delta)
+            yield delta
+
+            due = pending >= every_chunks or (time.monotonic() - last_save) * 1000 >= every_ms
+            if on_checkpoint and due and pending_chars >= min_chars:
+                on_checkpoint("".join(parts))
+                pending = 0
+                pending_chars = 0
+                last_save = time.monotonic()
+    finally:
+        # 中途断开时关闭上游连接，不再继续生成 (和计费)
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+        # 无论正常结束还是中途断开，都交出完整的已生成内容
+        if on_close:
+            on_close("".join(parts))
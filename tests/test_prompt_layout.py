@@ -0,0 +1,104 @@
+from mock_upstream import MockOpenAIClient
+from prompt_layout import PrefixCacheStats, assemble_prompt, message_digest
+
+SYSTEM = [{"role": "system", "content": "你是一个冷酷的暗夜刀锋GM。" * 100}]
+GLOSSARY = {f"Term{i}": f"术语{i}" for i in range(100)}
+CONSTRAINTS = [f"不要做第 {i} 件事" for i in range(50)]
+TAIL = "请用第二人称描述场景。"
+
+
+def build(chat, memory="", strategy="stable_prefix"):
+    return assemble_prompt(
+        SYSTEM,
+        chat,
+        long_term_memory=memory,
+        glossary=GLOSSARY,
+        negative_constraints=CONSTRAINTS,
+        tail_prompt=TAIL,
+        strategy=strategy,
+    )
+
+
+def headers(messages):
+    return [m["content"].split("\n")[0][:6] for m in messages]
+
+
+def test_stable_prefix_layout():
+    chat = [{"role": "user", "content": "开门", "is_dice": False}]
+    messages, prefix_len = build(chat, memory="旧事")
+    assert prefix_len == 3
+    assert headers(messages) == [SYSTEM[0]["content"][:6], "【术语对照 ", "【禁止事项 ", "【前情提要 ", "开门", TAIL[:6]]
+    # 自定义字段不会发给上游
+    assert all(set(m) == {"role", "content"} for m in messages)
+
+
+def test_legacy_layout():
+    messages, prefix_len = build([{"role": "user", "content": "开门"}], memory="旧事", strategy="legacy")
+    assert prefix_len == 1
+    assert headers(messages) == [SYSTEM[0]["content"][:6], "【前情提要 ", "开门", "【术语对照 ", "【禁止事项 ", TAIL[:6]]
+
+
+def test_stable_prefix_survives_memory_and_history_changes():
+    before, n = build([{"role": "user", "content": "开门"}], memory="旧事")
+    after, m = build([{"role": "user", "content": "拔刀"}], memory="新的前情提要")
+    assert message_digest(before[:n]) == message_digest(after[:m])
+
+
+def run_campaign(strategy, turns=16, compress_every=4):
+    """模拟一局跑团：每轮追加对话，每 compress_every 轮压缩一次记忆"""
+    client = MockOpenAIClient(prefix_cache=True, reply="刀光一闪。")
+    chat, memory = [], ""
+    for turn in range(turns):
+        chat.append({"role": "user", "content": f"第 {turn} 轮行动"})
+        messages, _ = build(chat, memory=memory, strategy=strategy)
+        reply = ""
+        for chunk in client.chat.completions.create(
+            model="m", messages=messages, stream=True, stream_options={"include_usage": True}
+        ):
+            if chunk.choices:
+                reply += chunk.choices[0].delta.content
+        chat.append({"role": "assistant", "content": reply})
+        if (turn + 1) % compress_every == 0:
+            memory = f"截至第 {turn} 轮的前情提要"
+            chat = chat[-2:]
+    return client.ttft_log
+
+
+def test_stable_prefix_caches_more_than_legacy_on_mock_upstream():
+    stable = run_campaign("stable_prefix")
+    legacy = run_campaign("legacy")
+
+    assert sum(r["prompt_tokens"] for r in stable) == sum(r["prompt_tokens"] for r in legacy)
+    assert sum(r["cached_tokens"] for r in stable) > sum(r["cached_tokens"] for r in legacy)
+    assert sum(r["ttft"] for r in stable) < sum(r["ttft"] for r in legacy)
+    # 压缩后的第一轮：stable_prefix 仍命中剧本 + 术语表 + 禁止事项
+    assert stable[4]["cached_tokens"] > legacy[4]["cached_tokens"] >= len(SYSTEM[0]["content"])
+
+
+def test_mock_cache_respects_ttl_and_min_tokens():
+    client = MockOpenAIClient(prefix_cache=True, min_cache_tokens=10_000)
+    messages, _ = build([{"role": "user", "content": "开门"}])
+    client.chat.completions.create(model="m", messages=messages)
+    response = client.chat.completions.create(model="m", messages=messages)
+    assert response.usage.prompt_tokens_details.cached_tokens == 0
+
+    client = MockOpenAIClient(prefix_cache=True, cache_ttl=0)
+    client.chat.completions.create(model="m", messages=messages)
+    response = client.chat.completions.create(model="m", messages=messages)
+    assert response.usage.prompt_tokens_details.cached_tokens == 0
+
+
+def test_prefix_cache_stats():
+    stats = PrefixCacheStats(ttl=300)
+    prefix, n = build([])
+    assert stats.record("ep", "m", prefix[:n])[1] is False
+    assert stats.record("ep", "m", prefix[:n])[1] is True
+    stats.record_ttft("ep", False, 300.0)
+    stats.record_ttft("ep", True, 100.0)
+    stats.record_provider_cache("ep", 1000, 750)
+
+    summary = stats.summary("ep")
+    assert summary["repeat_rate"] == 0.5
+    assert summary["provider_cached_ratio"] == 0.75
+    assert summary["avg_ttft_new_ms"] == 300.0
+    assert summary["avg_ttft_repeat_ms"] == 100.0
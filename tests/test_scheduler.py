@@ -0,0 +1,236 @@
+import threading
+import time
+
+import pytest
+
+from mock_upstream import MockOpenAIClient, RateLimitExceeded
+from scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, RequestScheduler, UserQuotaExceeded
+
+ENDPOINT = "http://mock-upstream/v1/"
+
+
+def wait_until(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not reached")
+        time.sleep(0.005)
+
+
+def run_queued(scheduler, requests):
+    """
+    先占住唯一的并发名额，按顺序排入 requests [(user, priority) 或 (user, priority, weight), ...]，
+    再释放名额，返回实际获得名额的顺序。
+    """
+    order = []
+    release = threading.Event()
+
+    def holder():
+        with scheduler.slot(ENDPOINT, "holder"):
+            release.wait()
+
+    def job(user, priority, tag, weight=1.0):
+        with scheduler.slot(ENDPOINT, user, priority=priority, weight=weight):
+            order.append(tag)
+
+    threads = [threading.Thread(target=holder)]
+    threads[0].start()
+    wait_until(lambda: scheduler.stats().get(ENDPOINT, {}).get("active") == 1)
+
+    for i, (user, priority, *weight) in enumerate(requests):
+        t = threading.Thread(target=job, args=(user, priority, f"{user}{i}", *weight))
+        t.start()
+        threads.append(t)
+        wait_until(lambda n=i + 1: scheduler.stats()[ENDPOINT]["waiting"] == n)
+
+    release.set()
+    for t in threads:
+        t.join(timeout=5)
+    return order
+
+
+def test_fair_ordering_between_sessions():
+    scheduler = RequestScheduler(max_concurrency=1)
+    order = run_queued(
+        scheduler,
+        [("A", PRIORITY_INTERACTIVE)] * 3 + [("B", PRIORITY_INTERACTIVE)],
+    )
+    # B 排在 A 的三个请求之后到达，但只需等 A 的第一个
+    assert order == ["A0", "B3", "A1", "A2"]
+
+
+def test_interactive_before_background():
+    scheduler = RequestScheduler(max_concurrency=1)
+    order = run_queued(
+        scheduler,
+        [("A", PRIORITY_BACKGROUND), ("B", PRIORITY_BACKGROUND), ("C", PRIORITY_INTERACTIVE)],
+    )
+    assert order == ["C2", "A0", "B1"]
+
+
+def test_queue_position_reported():
+    scheduler = RequestScheduler(max_concurrency=1)
+    positions = []
+    release = threading.Event()
+
+    def holder():
+        with scheduler.slot(ENDPOINT, "holder"):
+            release.wait()
+
+    t = threading.Thread(target=holder)
+    t.start()
+    wait_until(lambda: scheduler.stats().get(ENDPOINT, {}).get("active") == 1)
+
+    def job():
+        with scheduler.slot(ENDPOINT, "A", on_wait=positions.append):
+            pass
+
+    waiter = threading.Thread(target=job)
+    waiter.start()
+    wait_until(lambda: positions)
+    release.set()
+    t.join(timeout=5)
+    waiter.join(timeout=5)
+    assert positions == [1]
+
+
+def test_token_bucket_limits_rate():
+    scheduler = RequestScheduler(max_concurrency=4, rate_per_min=600, burst=1)  # 10 次/秒
+    started = time.monotonic()
+    for _ in range(6):
+        with scheduler.slot(ENDPOINT, "A"):
+            pass
+    # 第一个请求用掉突发令牌，之后每个至少等 0.1 秒
+    assert time.monotonic() - started >= 0.45
+
+
+def test_mock_upstream_enforces_rate_limit():
+    client = MockOpenAIClient(max_requests=3, window=1.0)
+    for _ in range(3):
+        client.chat.completions.create(model="m", messages=[])
+    with pytest.raises(RateLimitExceeded):
+        client.chat.completions.create(model="m", messages=[])
+
+
+def test_scheduler_keeps_upstream_under_rate_limit():
+    client = MockOpenAIClient(max_requests=4, window=0.5, reply="好", chunk_delay=0.01)
+    # 5 次/秒，突发 1：任意 0.5 秒窗口内最多 1 + 2.5 个请求
+    scheduler = RequestScheduler(max_concurrency=2, rate_per_min=300, burst=1)
+    errors = []
+
+    def table(user):
+        for _ in range(3):
+            try:
+                with scheduler.slot(client.base_url, user):
+                    for _ in client.chat.completions.create(model="m", messages=[], stream=True):
+                        pass
+            except RateLimitExceeded as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=table, args=(f"table{i}",)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=10)
+
+    assert errors == []
+    assert client.accepted == 12
+    assert client.peak_active <= 2
+
+
+def test_background_is_not_starved_by_interactive_traffic():
+    scheduler = RequestScheduler(max_concurrency=1, aging_seconds=0.2)
+    stop = threading.Event()
+    granted_after = []
+
+    def chatty_table(user):
+        while not stop.is_set():
+            with scheduler.slot(ENDPOINT, user, priority=PRIORITY_INTERACTIVE):
+                time.sleep(0.01)
+
+    tables = [threading.Thread(target=chatty_table, args=(f"table{i}",)) for i in range(3)]
+    for t in tables:
+        t.start()
+    time.sleep(0.05)
+
+    started = time.monotonic()
+    with scheduler.slot(ENDPOINT, "summary", priority=PRIORITY_BACKGROUND):
+        granted_after.append(time.monotonic() - started)
+    still_busy = not stop.is_set()
+
+    time.sleep(0.05)
+    stop.set()
+    for t in tables:
+        t.join(timeout=5)
+
+    # 老化后与交互请求同级，在交互流量仍持续时就能拿到名额
+    assert still_busy
+    assert granted_after[0] < 1.0
+
+
+def test_weight_gives_larger_share():
+    scheduler = RequestScheduler(max_concurrency=1)
+    order = run_queued(
+        scheduler,
+        [("A", PRIORITY_INTERACTIVE, 2.0)] * 2 + [("B", PRIORITY_INTERACTIVE, 1.0)] * 2,
+    )
+    assert order == ["A0", "A1", "B2", "B3"]
+
+
+def test_active_quota_lets_other_users_through():
+    scheduler = RequestScheduler(max_concurrency=2, max_active_per_user=1)
+    order = []
+    release = threading.Event()
+
+    def holder():
+        with scheduler.slot(ENDPOINT, "A"):
+            release.wait()
+
+    def job(user, tag):
+        with scheduler.slot(ENDPOINT, user):
+            order.append(tag)
+
+    threads = [threading.Thread(target=holder)]
+    threads[0].start()
+    wait_until(lambda: scheduler.stats().get(ENDPOINT, {}).get("active") == 1)
+
+    # A 已占满自己的配额，后到的 B 先于 A 的第二个请求获得空闲名额
+    threads.append(threading.Thread(target=job, args=("A", "A-second")))
+    threads[-1].start()
+    wait_until(lambda: scheduler.stats()[ENDPOINT]["waiting"] == 1)
+    threads.append(threading.Thread(target=job, args=("B", "B")))
+    threads[-1].start()
+    wait_until(lambda: order == ["B"])
+
+    release.set()
+    for t in threads:
+        t.join(timeout=5)
+    assert order == ["B", "A-second"]
+
+
+def test_queued_quota_rejects_excess_requests():
+    scheduler = RequestScheduler(max_concurrency=1, max_queued_per_user=1)
+    release = threading.Event()
+
+    def holder():
+        with scheduler.slot(ENDPOINT, "holder"):
+            release.wait()
+
+    def job():
+        with scheduler.slot(ENDPOINT, "A"):
+            pass
+
+    threads = [threading.Thread(target=holder), threading.Thread(target=job)]
+    threads[0].start()
+    wait_until(lambda: scheduler.stats().get(ENDPOINT, {}).get("active") == 1)
+    threads[1].start()
+    wait_until(lambda: scheduler.stats()[ENDPOINT]["waiting"] == 1)
+
+    with pytest.raises(UserQuotaExceeded):
+        with scheduler.slot(ENDPOINT, "A"):
+            pass
+
+    release.set()
+    for t in threads:
+        t.join(timeout=5)
+    assert scheduler.stats()[ENDPOINT] == {"active": 0, "waiting": 0}
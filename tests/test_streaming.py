@@ -0,0 +1,89 @@
+from mock_upstream import MockOpenAIClient
+from streaming import checkpointed_stream
+
+MODEL = "mock-model"
+MESSAGES = [{"role": "user", "content": "继续"}]
+
+
+def run_stream(client, **kwargs):
+    """跑完一次流式回复，返回 (产出的文本, 各次存档内容, 结束时交出的内容)"""
+    checkpoints = []
+    closed = []
+    stream = checkpointed_stream(
+        client.chat.completions.create(model=MODEL, messages=MESSAGES, stream=True),
+        on_checkpoint=checkpoints.append,
+        on_close=closed.append,
+        **kwargs,
+    )
+    return "".join(stream), checkpoints, closed
+
+
+def test_checkpoint_every_n_chunks():
+    client = MockOpenAIClient(reply="x" * 35)
+    text, checkpoints, closed = run_stream(client, every_ms=60_000, every_chunks=10, min_chars=0)
+
+    assert text == "x" * 35
+    assert [len(c) for c in checkpoints] == [10, 20, 30]
+    assert closed == ["x" * 35]
+
+
+def test_checkpoint_waits_for_min_chars():
+    client = MockOpenAIClient(reply="x" * 35)
+    _, checkpoints, _ = run_stream(client, every_ms=60_000, every_chunks=1, min_chars=15)
+
+    assert [len(c) for c in checkpoints] == [15, 30]
+
+
+def test_checkpoint_every_t_ms():
+    client = MockOpenAIClient(reply="x" * 30, chunk_delay=0.02)
+    _, checkpoints, closed = run_stream(client, every_ms=100, every_chunks=1000, min_chars=0)
+
+    # 30 块 * 20ms ≈ 600ms，约每 5 块存档一次
+    assert 3 <= len(checkpoints) <= 6
+    assert all(0 < len(c) <= 30 for c in checkpoints)
+    assert closed == ["x" * 30]
+
+
+def test_fast_stream_is_not_checkpointed_before_t_ms():
+    client = MockOpenAIClient(reply="x" * 30)
+    _, checkpoints, closed = run_stream(client, every_ms=60_000, every_chunks=1000, min_chars=0)
+
+    assert checkpoints == []
+    assert closed == ["x" * 30]
+
+
+def test_close_flushes_partial_and_closes_upstream():
+    client = MockOpenAIClient(reply="abcdefghij", chunk_delay=0.001)
+    usage = []
+    closed = []
+    stream = checkpointed_stream(
+        client.chat.completions.create(
+            model=MODEL, messages=MESSAGES, stream=True, stream_options={"include_usage": True}
+        ),
+        prefix="前文",
+        on_close=closed.append,
+        on_usage=usage.append,
+    )
+    received = [next(stream) for _ in range(4)]
+    assert client.active == 1
+
+    stream.close()
+
+    assert received == list("abcd")
+    assert closed == ["前文abcd"]
+    assert usage == []
+    assert client.active == 0
+
+
+def test_usage_chunk_is_reported():
+    client = MockOpenAIClient(reply="abc")
+    usage = []
+    stream = checkpointed_stream(
+        client.chat.completions.create(
+            model=MODEL, messages=MESSAGES, stream=True, stream_options={"include_usage": True}
+        ),
+        on_usage=usage.append,
+    )
+
+    assert "".join(stream) == "abc"
+    assert len(usage) == 1 and usage[0].completion_tokens == 3
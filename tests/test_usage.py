@@ -0,0 +1,111 @@
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from usage import UsageLedger, estimate_prompt_tokens, estimate_tokens, load_model_prices, usage_tokens
+
+PRICES = {"gm-model": {"input": 1.0, "output": 4.0}}
+
+
+@pytest.fixture
+def usage_file(tmp_path):
+    return tmp_path / "usage_rollup.json"
+
+
+def test_record_aggregates_every_bucket(usage_file):
+    ledger = UsageLedger(str(usage_file), PRICES, flush_interval=0)
+    ledger.record("s1", "u1", "暗夜", "gm-model", 100, 20, kind="reply")
+    ledger.record("s2", "u1", "暗夜", "gm-model", 50, 10, estimated=True, kind="summary")
+    ledger.record("s3", "u2", "其他", "gm-model", 10, 1, kind="reply")
+
+    user = ledger.get("users", "u1")
+    assert (user["requests"], user["prompt_tokens"], user["completion_tokens"]) == (2, 150, 30)
+    assert user["estimated_requests"] == 1
+    assert user["by_kind"] == {"reply": 120, "summary": 60}
+
+    assert ledger.get("sessions", "s1")["user"] == "u1"
+    assert ledger.get("masks", "暗夜")["requests"] == 2
+    assert ledger.get("models", "gm-model")["requests"] == 3
+    assert ledger.get("users", "missing") == {}
+
+
+def test_cost_uses_prices_per_million_tokens(usage_file):
+    ledger = UsageLedger(str(usage_file), PRICES)
+    assert ledger.cost("gm-model", 1_000_000, 500_000) == pytest.approx(3.0)
+    assert ledger.cost("unpriced", 1_000_000, 1_000_000) == 0
+
+
+def test_load_model_prices_skips_bad_entries():
+    raw = json.dumps({"good": {"input": "0.5", "output": 3}, "partial": {"input": 1}, "bad": 5, "worse": {"input": "x"}})
+    assert load_model_prices(raw) == {"good": {"input": 0.5, "output": 3.0}, "partial": {"input": 1.0, "output": 0.0}}
+    assert load_model_prices({"table": {"input": 2}}) == {"table": {"input": 2.0, "output": 0.0}}
+    assert load_model_prices("not json") == {}
+    assert load_model_prices("[1, 2]") == {}
+    assert load_model_prices(None) == {}
+
+
+def test_reported_usage_is_preferred_over_estimate():
+    messages = [{"role": "user", "content": "你好"}]
+    reported = SimpleNamespace(prompt_tokens=30, completion_tokens=None)
+    assert usage_tokens(reported, messages, "回复") == (30, 0, False)
+    assert usage_tokens(None, messages, "回复") == (estimate_prompt_tokens(messages), estimate_tokens("回复"), True)
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("你好世界") == 4
+    assert estimate_tokens("abcdefgh") == 2
+    assert estimate_tokens(None) == 0
+    assert estimate_prompt_tokens([{"content": "你好"}, {"content": ""}]) == 10
+
+
+def test_reload_from_existing_file(usage_file):
+    ledger = UsageLedger(str(usage_file), PRICES, flush_interval=0)
+    ledger.record("s1", "u1", "暗夜", "gm-model", 100, 20)
+
+    reloaded = UsageLedger(str(usage_file), PRICES, flush_interval=0)
+    reloaded.record("s1", "u1", "暗夜", "gm-model", 1, 1)
+    assert reloaded.get("sessions", "s1")["prompt_tokens"] == 101
+    assert reloaded.get("models", "gm-model")["cost"] == pytest.approx((101 * 1.0 + 21 * 4.0) / 1_000_000)
+
+
+def test_corrupt_file_starts_empty(usage_file):
+    usage_file.write_text("{not json", encoding="utf-8")
+    ledger = UsageLedger(str(usage_file), PRICES)
+    assert ledger.get("users", "u1") == {}
+
+
+def test_writes_are_throttled_until_flush(usage_file):
+    ledger = UsageLedger(str(usage_file), PRICES, flush_interval=60)
+    ledger.record("s1", "u1", "暗夜", "gm-model", 10, 1)
+    assert not usage_file.exists()
+
+    ledger.flush()
+    assert json.loads(usage_file.read_text(encoding="utf-8"))["users"]["u1"]["requests"] == 1
+
+
+def test_flush_drops_stale_sessions_but_keeps_totals(usage_file):
+    ledger = UsageLedger(str(usage_file), PRICES, flush_interval=60, session_retention_days=1)
+    ledger.record("old", "u1", "暗夜", "gm-model", 10, 1)
+    ledger.record("new", "u1", "暗夜", "gm-model", 10, 1)
+    ledger.data["sessions"]["old"]["updated"] = time.time() - 2 * 86400
+
+    ledger.flush()
+    saved = json.loads(usage_file.read_text(encoding="utf-8"))
+    assert list(saved["sessions"]) == ["new"]
+    assert saved["users"]["u1"]["requests"] == 2
+
+
+def test_export_for_one_user_only_includes_their_data(usage_file):
+    ledger = UsageLedger(str(usage_file), PRICES)
+    ledger.record("s1", "u1", "暗夜", "gm-model", 10, 1)
+    ledger.record("s2", "u2", "暗夜", "gm-model", 10, 1)
+
+    mine = json.loads(ledger.export(user_id="u1"))
+    assert list(mine["users"]) == ["u1"]
+    assert list(mine["sessions"]) == ["s1"]
+    assert "masks" not in mine
+
+    everything = json.loads(ledger.export())
+    assert set(everything["users"]) == {"u1", "u2"}
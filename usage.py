@@ -0,0 +1,160 @@
+"""
+Token 用量统计 (不依赖 Streamlit，可单独导入测试)。
+
+每次调用的 token 用量按 会话 / 用户 / 剧本 / 模型 汇总，定期写入服务器本地的 JSON 文件。
+上游未返回 usage 时使用本地估算，并计入 estimated_requests。
+"""
+import copy
+import json
+import os
+import threading
+import time
+
+
+def estimate_tokens(text):
+    """粗略估算 token 数：中日韩字符约 1 字 1 token，其余约 4 字符 1 token"""
+    text = str(text or "")
+    cjk = sum(1 for ch in text if "\u3000" <= ch <= "\u9fff" or "\uac00" <= ch <= "\ud7af" or "\uff00" <= ch <= "\uffef")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimate_prompt_tokens(messages):
+    # 每条消息额外约 4 个 token 的格式开销
+    return sum(estimate_tokens(m["content"]) + 4 for m in messages)
+
+
+def usage_tokens(usage, prompt_messages, completion_text):
+    """
+    返回 (prompt_tokens, completion_tokens, estimated)；
+    usage 为上游返回的 usage 对象，为 None 时按消息内容本地估算。
+    """
+    if usage is not None:
+        return usage.prompt_tokens or 0, usage.completion_tokens or 0, False
+    return estimate_prompt_tokens(prompt_messages), estimate_tokens(completion_text), True
+
+
+def load_model_prices(raw):
+    """
+    raw 为 MODEL_PRICES 配置：按模型配置每百万 token 的价格，
+    例如 {"gemini-3-flash-preview": {"input": 0.5, "output": 3.0}}，未配置的模型费用记为 0。
+    格式错误的条目只打日志并忽略。
+    """
+    if not raw:
+        return {}
+    try:
+        # 环境变量中是 JSON 字符串，secrets.toml 中是表
+        prices = json.loads(raw) if isinstance(raw, str) else dict(raw)
+    except (TypeError, ValueError) as e:
+        print(f"DEBUG: Invalid MODEL_PRICES: {e}")
+        return {}
+    if not isinstance(prices, dict):
+        print("DEBUG: Invalid MODEL_PRICES: expected an object keyed by model")
+        return {}
+
+    valid = {}
+    for model, price in prices.items():
+        try:
+            valid[model] = {k: float(price.get(k, 0)) for k in ("input", "output")}
+        except (AttributeError, TypeError, ValueError):
+            print(f"DEBUG: Ignoring MODEL_PRICES entry for {model}: expected {{\"input\": ..., \"output\": ...}}")
+    return valid
+
+
+class UsageLedger:
+    """
+    线程安全的用量汇总：
+    - flush_interval: 两次写文件之间至少间隔的秒数，期间的记录只更新内存 (<= 0 为每次记录都写)；
+      进程退出前应调用 flush() 写入剩余记录
+    - session_retention_days: 会话条目超过这么多天未更新就从文件中移除 (<= 0 为永久保留)，
+      其用量仍计入 users / masks / models 汇总
+    """
+
+    BUCKETS = ("sessions", "users", "masks", "models")
+
+    def __init__(self, path, prices, flush_interval=30.0, session_retention_days=30):
+        self.path = path
+        self.prices = prices
+        self.flush_interval = float(flush_interval)
+        self.session_retention = float(session_retention_days) * 86400
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_flush = time.monotonic()
+        self.data = {bucket: {} for bucket in self.BUCKETS}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                loaded = json.load(f)
+            for bucket in self.BUCKETS:
+                self.data[bucket].update(loaded.get(bucket, {}))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"DEBUG: Failed to load usage file {path}: {e}")
+
+    def cost(self, model, prompt_tokens, completion_tokens):
+        price = self.prices.get(model, {})
+        return (prompt_tokens * price.get("input", 0) + completion_tokens * price.get("output", 0)) / 1_000_000
+
+    def record(self, session_id, user_id, mask, model, prompt_tokens, completion_tokens, estimated=False, kind="reply"):
+        cost = self.cost(model, prompt_tokens, completion_tokens)
+        keys = {"sessions": session_id, "users": user_id, "masks": mask, "models": model}
+        with self._lock:
+            for bucket, key in keys.items():
+                entry = self.data[bucket].setdefault(
+                    key or "unknown",
+                    {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "estimated_requests": 0, "cost": 0.0, "by_kind": {}},
+                )
+                entry["requests"] += 1
+                entry["prompt_tokens"] += prompt_tokens
+                entry["completion_tokens"] += completion_tokens
+                entry["estimated_requests"] += int(estimated)
+                entry["cost"] += cost
+                entry["by_kind"][kind] = entry["by_kind"].get(kind, 0) + prompt_tokens + completion_tokens
+                entry["updated"] = time.time()
+                if bucket == "sessions":
+                    entry.update({"user": user_id, "mask": mask, "model": model})
+            self._dirty = True
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        """立即写入尚未落盘的记录"""
+        with self._lock:
+            if self._dirty:
+                self._flush()
+
+    def _prune_sessions(self):
+        if self.session_retention <= 0:
+            return
+        cutoff = time.time() - self.session_retention
+        sessions = self.data["sessions"]
+        for key in [k for k, v in sessions.items() if v.get("updated", 0) < cutoff]:
+            del sessions[key]
+
+    def _flush(self):
+        # 调用方持有 self._lock
+        self._prune_sessions()
+        self._last_flush = time.monotonic()
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except Exception as e:
+            print(f"DEBUG: Failed to write usage file {self.path}: {e}")
+
+    def get(self, bucket, key):
+        with self._lock:
+            return copy.deepcopy(self.data[bucket].get(key, {}))
+
+    def export(self, user_id=None):
+        """导出为 JSON 字符串；指定 user_id 时只包含该用户自己的汇总和会话"""
+        with self._lock:
+            if user_id is None:
+                data = self.data
+            else:
+                data = {
+                    "users": {k: v for k, v in self.data["users"].items() if k == user_id},
+                    "sessions": {k: v for k, v in self.data["sessions"].items() if v.get("user") == user_id},
+                }
+            return json.dumps(data, ensure_ascii=False, indent=2)